@@ -1,10 +1,12 @@
-from io import StringIO
-import re
+from io import BytesIO, TextIOBase
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
 import json
 import logging
 
-from pytiblegenc import DuffedTextConverter
+from pytiblegenc import DuffedTextConverter, USUAL_LA_PARAMS
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
@@ -21,10 +23,13 @@ from pdfminer.layout import LAParams
 #REGION = [99,0,645,100000] # KWKB
 REGION = None
 
+# for single column documents, passing laparams=pytiblegenc.FAST_LA_PARAMS to the
+# conversion functions skips the grouping of text boxes
 
 
-def converted_txt_from_pdf(pdf_file_name, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True):
-    stats = {
+
+def new_stats():
+    return {
         "unhandled_fonts": {},
         "handled_fonts": {},
         "unknown_characters": {},
@@ -32,40 +37,226 @@ def converted_txt_from_pdf(pdf_file_name, region=None, page_break_str="\n\n-- pa
         "diffs_with_utfc": {},
         "nb_non_horizontal_removed": 0
     }
-    output_string = StringIO()
-    with open(pdf_file_name, 'rb') as in_file:
-        parser = PDFParser(in_file)
-        doc = PDFDocument(parser)
-        rsrcmgr = PDFResourceManager()
-        device = DuffedTextConverter(rsrcmgr, output_string, stats, region = region, pbs = page_break_str, remove_non_hz=remove_non_hz)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
-        pnum = 1
-        for page in PDFPage.create_pages(doc):
-            interpreter.process_page(page)
-            pnum += 1
-            #break
-    res = output_string.getvalue()
-    res = re.sub(r"\n\n+", "\n", res)
+
+def merge_stats(stats, other):
+    for k, v in other.items():
+        if not isinstance(v, dict):
+            stats[k] += v
+            continue
+        for k2, v2 in v.items():
+            if isinstance(v2, dict):
+                # unknown_characters: font name -> character -> count
+                font_stats = stats[k].setdefault(k2, {})
+                for c, nb in v2.items():
+                    font_stats[c] = font_stats.get(c, 0) + nb
+            else:
+                stats[k][k2] = stats[k].get(k2, 0) + v2
+
+class NewlineCollapsingWriter(TextIOBase):
+    """
+    writes to fp while replacing runs of newlines by a single one, the result
+    is the same as re.sub(r"\n\n+", "\n", ...) on the whole text but without
+    keeping a second copy of it
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.last_is_newline = False
+
+    def write(self, s):
+        nb_chars = len(s)
+        if self.last_is_newline:
+            s = s.lstrip("\n")
+        if s:
+            # str.replace is much cheaper than the regex on a literal, each
+            # pass halves the remaining runs
+            while "\n\n" in s:
+                s = s.replace("\n\n", "\n")
+            self.last_is_newline = s.endswith("\n")
+            self.fp.write(s)
+        return nb_chars
+
+class TextAccumulator:
+    """
+    collects the written strings and joins them once in getvalue(), used
+    instead of a StringIO that would grow its buffer along the way
+    """
+    __slots__ = ("parts",)
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s)
+        return len(s)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+def print_stats(stats):
     print(json.dumps(stats))
     for fontname in stats["unknown_characters"]:
         for c in stats["unknown_characters"][fontname]:
             print("%s,%d,??(%s)" % (fontname, ord(c), c))
-    return res
 
-def convert_folder(input_folder="input/", output_folder="output/", region=None, page_break_str="\n\n-- page {} --\n\n"):
+# PDFs smaller than this are read in memory at once
+MAX_IN_MEMORY_PDF_SIZE = 100 * 1024 * 1024
+# buffer size for the PDFs that are not read in memory
+PDF_BUFFER_SIZE = 1024 * 1024
+
+def open_pdf(pdf_file_name):
+    # pdfminer does many small reads and seeks, which are much cheaper in
+    # memory than through the default 8KB file buffer
+    if os.path.getsize(pdf_file_name) < MAX_IN_MEMORY_PDF_SIZE:
+        with open(pdf_file_name, 'rb') as f:
+            return BytesIO(f.read())
+    return open(pdf_file_name, 'rb', buffering=PDF_BUFFER_SIZE)
+
+def convert_pdf_to_fp(in_file, output_fp, stats, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True, laparams=USUAL_LA_PARAMS):
+    """
+    writes the converted text of in_file to output_fp page by page
+    """
+    parser = PDFParser(in_file)
+    doc = PDFDocument(parser)
+    rsrcmgr = PDFResourceManager()
+    device = DuffedTextConverter(rsrcmgr, NewlineCollapsingWriter(output_fp), stats, region = region, pbs = page_break_str, remove_non_hz=remove_non_hz, laparams=laparams)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    for page in PDFPage.create_pages(doc):
+        interpreter.process_page(page)
+
+def converted_txt_from_pdf(pdf_file_name, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True, laparams=USUAL_LA_PARAMS):
+    stats = new_stats()
+    output_string = TextAccumulator()
+    with open_pdf(pdf_file_name) as in_file:
+        convert_pdf_to_fp(in_file, output_string, stats, region, page_break_str, remove_non_hz, laparams)
+    print_stats(stats)
+    return output_string.getvalue()
+
+def convert_pdf_to_txt_file(pdf_file_name, txt_path, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True, executor=None, max_workers=None, laparams=USUAL_LA_PARAMS):
+    """
+    same as converted_txt_from_pdf but the text is streamed to txt_path
+    instead of being kept in memory. If executor is given, the pages are
+    interpreted in parallel as in converted_txt_from_pdf_parallel.
+    """
+    stats = new_stats()
+    # written next to txt_path and renamed at the end so that a PDF that
+    # fails to convert doesn't leave a truncated file
+    tmp_path = Path(txt_path).with_suffix(".txt.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as out_file:
+            if executor is None:
+                with open_pdf(pdf_file_name) as in_file:
+                    convert_pdf_to_fp(in_file, out_file, stats, region, page_break_str, remove_non_hz, laparams)
+            else:
+                convert_pdf_to_fp_parallel(pdf_file_name, out_file, stats, executor, max_workers, region, page_break_str, remove_non_hz, laparams)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, txt_path)
+    print_stats(stats)
+
+def _converted_pages(pdf_file_name, first_page, nb_pages, region, page_break_str, remove_non_hz, laparams):
+    # runs in a worker process: only picklable arguments go in and out
+    stats = new_stats()
+    output_string = TextAccumulator()
+    # a range only reads a part of the file, so it isn't read in memory
+    with open(pdf_file_name, 'rb', buffering=PDF_BUFFER_SIZE) as in_file:
+        rsrcmgr = PDFResourceManager()
+        # pageno is what the page break string uses for the page number
+        device = DuffedTextConverter(rsrcmgr, NewlineCollapsingWriter(output_string), stats, pageno = first_page+1, region = region, pbs = page_break_str, remove_non_hz=remove_non_hz, laparams=laparams)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        # maxpages stops the page tree walk at the end of the range
+        for page in PDFPage.get_pages(in_file, pagenos=range(first_page, first_page+nb_pages), maxpages=first_page+nb_pages):
+            interpreter.process_page(page)
+    return output_string.getvalue(), stats
+
+def default_max_workers(max_workers):
+    if max_workers is None:
+        return min(os.cpu_count() or 1, 4)
+    return max_workers
+
+def convert_pdf_to_fp_parallel(pdf_file_name, output_fp, stats, executor, max_workers=None, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True, laparams=USUAL_LA_PARAMS):
+    """
+    writes the converted text of pdf_file_name to output_fp, the ranges of
+    pages are converted by executor and written in order as they complete.
+    max_workers should be the number of workers of executor, it is only used
+    to size the ranges.
+    """
+    max_workers = default_max_workers(max_workers)
+    with open_pdf(pdf_file_name) as in_file:
+        doc = PDFDocument(PDFParser(in_file))
+        nb_pages = sum(1 for _ in PDFPage.create_pages(doc))
+    # a few ranges per worker so that a slow range doesn't leave the others idle
+    range_size = max(1, -(-nb_pages // (max_workers * 4)))
+    first_pages = range(0, nb_pages, range_size)
+    # the ranges are already collapsed, this only handles the newlines around
+    # the junctions between two ranges
+    writer = NewlineCollapsingWriter(output_fp)
+    # at most max_pending ranges are submitted and not yet written, so that
+    # the results waiting behind a slow range don't pile up in memory
+    max_pending = 2 * max_workers
+    pending = deque()
+
+    def write_next():
+        text, range_stats = pending.popleft().result()
+        writer.write(text)
+        merge_stats(stats, range_stats)
+
+    try:
+        for first_page in first_pages:
+            if len(pending) >= max_pending:
+                write_next()
+            pending.append(executor.submit(_converted_pages, pdf_file_name, first_page, min(range_size, nb_pages - first_page), region, page_break_str, remove_non_hz, laparams))
+        while pending:
+            write_next()
+    except BaseException:
+        # the executor can be shared with other documents
+        for future in pending:
+            future.cancel()
+        raise
+
+def converted_txt_from_pdf_parallel(pdf_file_name, region=None, page_break_str="\n\n-- page {} --\n\n", remove_non_hz=True, max_workers=None, executor=None, laparams=USUAL_LA_PARAMS):
+    """
+    same as converted_txt_from_pdf but the pages are interpreted in parallel
+    in max_workers processes, each one converting a range of consecutive pages.
+    A ProcessPoolExecutor with max_workers workers can be passed to reuse it
+    for several documents, otherwise one is created for this call.
+    """
+    max_workers = default_max_workers(max_workers)
+    stats = new_stats()
+    output_string = TextAccumulator()
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            convert_pdf_to_fp_parallel(pdf_file_name, output_string, stats, executor, max_workers, region, page_break_str, remove_non_hz, laparams)
+    else:
+        convert_pdf_to_fp_parallel(pdf_file_name, output_string, stats, executor, max_workers, region, page_break_str, remove_non_hz, laparams)
+    print_stats(stats)
+    return output_string.getvalue()
+
+def convert_folder(input_folder="input/", output_folder="output/", region=None, page_break_str="\n\n-- page {} --\n\n", max_workers=1, laparams=USUAL_LA_PARAMS):
     paths = sorted(Path(input_folder).glob("*.pdf"))
-    for path in paths:
-        try:
-            txt = converted_txt_from_pdf(path, region, page_break_str)
-            txt_path = Path(output_folder) / Path(str(path.stem) + ".txt")
-            print(txt_path)
-            with open(txt_path, "w", encoding="utf-8") as f:
-                f.write(txt)
-        except ValueError:
-            print("couldn't open %s" % path)
-
-# [0,50,1000000,500]
-convert_folder("input5/", "output/", None, "\n\n-- page {} --\n\n")
+    executor = None
+    # max_workers=None uses the default size, which is 1 on a single CPU: a
+    # pool only adds overhead then
+    max_workers = default_max_workers(max_workers)
+    if max_workers != 1:
+        # one pool for the whole folder
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        for path in paths:
+            try:
+                txt_path = Path(output_folder) / Path(str(path.stem) + ".txt")
+                convert_pdf_to_txt_file(path, txt_path, region, page_break_str, laparams=laparams, executor=executor, max_workers=max_workers)
+                print(txt_path)
+            except ValueError:
+                print("couldn't open %s" % path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+if __name__ == "__main__":
+    # the guard is needed for the worker processes of converted_txt_from_pdf_parallel
+    # [0,50,1000000,500]
+    convert_folder("input5/", "output/", None, "\n\n-- page {} --\n\n")
 # for KR: cropbox is 595x842
 # margin left = 550/4674  * 842 = 99
 # right region = 4133/4674  * 842 = 744
@@ -27,9 +27,11 @@ def get_base_from_file(filename):
     with open(str(path), newline='', encoding="utf-8") as csvfile:
         reader = csv.reader(csvfile, quotechar='"')
         for row in reader:
-            if row[0] not in base:
-                base[row[0]] = {}
-            base[row[0]][chr(int(row[1]))] = row[2]
+            font_base = base.get(row[0])
+            if font_base is None:
+                font_base = {}
+                base[row[0]] = font_base
+            font_base[chr(int(row[1]))] = row[2]
     return base
 
 FONT_ALIASES = {
@@ -39,22 +41,63 @@ FONT_ALIASES = {
     "TibetanChogyalSkt": "TibetanChogyalSkt1",
 }
 
+NORMALIZED_FONT_NAMES = {}
+
+def normalize_font_name(font_name):
+    res = NORMALIZED_FONT_NAMES.get(font_name)
+    if res is not None:
+        return res
+    res = font_name
+    if res in FONT_ALIASES:
+        res = FONT_ALIASES[res]
+    if res.startswith("Dedris"):
+        res = "Ed"+res[1:]
+    # Todo: also replace "Drutsa-" and "Khamdris-" to "Ededris-"
+    if res.startswith("Sam") and len(res) == 4:
+        res = "Es"+res[1:]
+    NORMALIZED_FONT_NAMES[font_name] = res
+    return res
+
 def uni_char_from_encoding(nonunicp, encoding="cp1252"):
     noncpbytes = nonunicp.to_bytes(1, "big")
     try:
         unistr = noncpbytes.decode("cp1252")
-        logging.debug("decoding %d (%s) into %s (%d)" % (nonunicp, noncpbytes.hex(), unistr, ord(unistr)))
+        logging.debug("decoding %d (%s) into %s (%d)", nonunicp, noncpbytes.hex(), unistr, ord(unistr))
     except UnicodeDecodeError:
         return
 
-def _convert_char(char, font_name, stats):
+# (font_name, char) -> (status, res, utfc_res), see _lookup_char
+CHAR_LOOKUPS = {}
+
+def _lookup_char(char, font_name):
     base = get_base()
     utfc_base = get_utfc_base()
-    if char == "\u00a0":
-        char = " "
     base_ft = base.get(font_name)
     utfc_base_ft = utfc_base.get(font_name)
     if (base_ft is None or char not in base_ft) and (utfc_base_ft is None or char not in utfc_base_ft):
+        return ("unknown", None, None)
+    res = base_ft.get(char) if base_ft is not None else None
+    utfc_res = utfc_base_ft.get(char) if utfc_base_ft is not None else None
+    if res is not None and utfc_res is not None and res != utfc_res:
+        return ("diff", res, utfc_res)
+    if res == ERROR_CHR:
+        return ("error", res, None)
+    return (None, res if res is not None else utfc_res, None)
+
+def _convert_char(char, font_name, stats):
+    # the tables are static so the lookup is memoized, the stats are still
+    # updated for each character
+    if char == "\u00a0":
+        char = " "
+    key = (font_name, char)
+    lookup = CHAR_LOOKUPS.get(key)
+    if lookup is None:
+        lookup = _lookup_char(char, font_name)
+        CHAR_LOOKUPS[key] = lookup
+    status, res, utfc_res = lookup
+    if status is None:
+        return res
+    if status == "unknown":
         if font_name not in stats["unknown_characters"]:
             stats["unknown_characters"][font_name] = {}
         if char not in stats["unknown_characters"][font_name]:
@@ -66,9 +109,7 @@ def _convert_char(char, font_name, stats):
             return "[[%s]]" % (char)
         else:
             return ""
-    res = base_ft.get(char) if base_ft is not None else None
-    utfc_res = utfc_base_ft.get(char) if utfc_base_ft is not None else None
-    if res is not None and utfc_res is not None and res != utfc_res:
+    if status == "diff":
         stats_key = "%s,%d" % (font_name, ord(char))
         if stats_key not in stats["diffs_with_utfc"]:
             stats["diffs_with_utfc"][stats_key] = 0
@@ -77,24 +118,16 @@ def _convert_char(char, font_name, stats):
             return "[[%s,%d,%s or %s]]" % (font_name, ord(char), res, utfc_res)
         else:
             return res
-    if res == ERROR_CHR:
-        stats["error_characters"] += 1
-        if DEBUGMODE:
-            return '[[ERR]]'
-        else:
-            return ''
-    return res if res is not None else utfc_res
+    stats["error_characters"] += 1
+    if DEBUGMODE:
+        return '[[ERR]]'
+    else:
+        return ''
 
 def convert_string(s, font_name, stats):
     if s.startswith("(cid:"):
         return ""
-    if font_name in FONT_ALIASES:
-        font_name = FONT_ALIASES[font_name]
-    if font_name.startswith("Dedris"):
-        font_name = "Ed"+font_name[1:]
-    # Todo: also replace "Drutsa-" and "Khamdris-" to "Ededris-"
-    if font_name.startswith("Sam") and len(font_name) == 4:
-        font_name = "Es"+font_name[1:]
+    font_name = normalize_font_name(font_name)
     base = get_base()
     utfc_base = get_utfc_base()
     if font_name not in base and font_name not in utfc_base:
@@ -105,8 +138,6 @@ def convert_string(s, font_name, stats):
     if font_name not in stats["handled_fonts"]:
         stats["handled_fonts"][font_name] = 0
     stats["handled_fonts"][font_name] += 1
-    res = ''
-    for char in s:
-        res += _convert_char(char, font_name, stats)
+    res = ''.join([_convert_char(char, font_name, stats) for char in s])
     #logging.error("converted %s:%s -> %s" % (font_name, s, res))
     return res
\ No newline at end of file
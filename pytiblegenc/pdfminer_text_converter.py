@@ -4,6 +4,7 @@ from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfparser import PDFParser
+from pdfminer.pdffont import PDFUnicodeNotDefined
 from pdfminer.layout import LAParams, LTComponent, TextGroupElement
 from pdfminer.layout import LTAnno
 from pdfminer.layout import LTChar
@@ -22,10 +23,10 @@ from pdfminer.layout import LTTextBoxVertical
 from pdfminer.layout import LTTextGroup
 from pdfminer.layout import LTTextLine
 from pdfminer.converter import PDFLayoutAnalyzer
-from pdfminer.utils import AnyIO, Point, Matrix, Rect, PathSegment, make_compat_str, compatible_encode_method
-from pdfminer.utils import apply_matrix_pt
+from pdfminer.utils import AnyIO, Point, Matrix, Rect, PathSegment, make_compat_str
+from pdfminer.utils import apply_matrix_pt, apply_matrix_rect
 
-from .char_converter import convert_string
+from .char_converter import convert_string, normalize_font_name
 import logging
 
 from typing import (
@@ -43,6 +44,10 @@ from typing import (
 )
 
 USUAL_LA_PARAMS = LAParams(word_margin=10000, char_margin=1000)
+# faster alternative to USUAL_LA_PARAMS: boxes_flow=None makes pdfminer skip the
+# hierarchical grouping of text boxes (group_textboxes) and just sort them
+# from top to bottom, which is enough for single column pages
+FAST_LA_PARAMS = LAParams(word_margin=10000, char_margin=1000, boxes_flow=None)
 
 # see https://github.com/pdfminer/pdfminer.six/issues/900
 # for some reason pdfminer uses the mediabox coordinates for LTPage
@@ -70,8 +75,36 @@ def cropbox_process_page(self, page: PDFPage) -> None:
     self.render_contents(page.resources, page.contents, ctm=ctm)
     self.device.end_page(page)
 
-PDFLayoutAnalyzer.begin_page = cropbox_begin_page
-PDFPageInterpreter.process_page = cropbox_process_page
+# patch only once, even if the module is reloaded or imported under two names
+if not getattr(PDFLayoutAnalyzer.begin_page, "cropbox_patched", False):
+    cropbox_begin_page.cropbox_patched = True
+    PDFLayoutAnalyzer.begin_page = cropbox_begin_page
+if not getattr(PDFPageInterpreter.process_page, "cropbox_patched", False):
+    cropbox_process_page.cropbox_patched = True
+    PDFPageInterpreter.process_page = cropbox_process_page
+
+END_OF_TEXTBOX = object()
+
+# how receive_layout handles each layout class, filled by layout_kind() so
+# that the isinstance tests run once per class instead of once per item
+TEXTBOX, CONTAINER, TEXT, IMAGE, OTHER = range(5)
+LAYOUT_KINDS = {}
+
+def layout_kind(item_type):
+    kind = LAYOUT_KINDS.get(item_type)
+    if kind is None:
+        if issubclass(item_type, LTTextBox):
+            kind = TEXTBOX
+        elif issubclass(item_type, LTContainer):
+            kind = CONTAINER
+        elif issubclass(item_type, LTText):
+            kind = TEXT
+        elif issubclass(item_type, LTImage):
+            kind = IMAGE
+        else:
+            kind = OTHER
+        LAYOUT_KINDS[item_type] = kind
+    return kind
 
 class DuffedTextConverter(PDFConverter[AnyIO]):
     def __init__(
@@ -98,92 +131,200 @@ class DuffedTextConverter(PDFConverter[AnyIO]):
         self.maxlines = maxlines
         self.pbs = pbs
         self.remove_non_hz = remove_non_hz
+        # cache of resolve_fontname()
+        self.fontnames = {}
+        # fonts for which convert_string returned None (no conversion table)
+        self.unhandled_fontnames = set()
+        # cache of page_box()
+        self.box_ltpage = None
+        self.box = None
+        self.render_ltpage = None
+        # text of the current page, written to outfp in one go by flush_text()
+        self.page_text = []
 
     def scale_region_box(self, ltpage):
         if not hasattr(ltpage, "x0"):
-            return self.region
-        res = []
+            return tuple(self.region)
+        def scale(c, size, origin):
+            if c > 0 and c < 1:
+                return int(c * size) + origin
+            return c
+        (x0, y0, x1, y1) = self.region
         ltpage_w = ltpage.x1 - ltpage.x0
         ltpage_h = ltpage.y1 - ltpage.y0
-        for i, c in enumerate(self.region):
-            if c > 0 and c < 1:
-                if i % 2 == 0:
-                    c = int(c * ltpage_w) + ltpage.x0 
+        return (
+            scale(x0, ltpage_w, ltpage.x0),
+            scale(y0, ltpage_h, ltpage.y0),
+            scale(x1, ltpage_w, ltpage.x0),
+            scale(y1, ltpage_h, ltpage.y0),
+        )
+
+    def page_box(self, ltpage):
+        # items are kept if they are both in the page and in the region, which
+        # is the same as being in the intersection of the two boxes. It only
+        # depends on the page so it is computed for the first item of each
+        # page and reused for the others. None means that everything is kept.
+        if self.box_ltpage is not ltpage:
+            self.box_ltpage = ltpage
+            box = ltpage.bbox if hasattr(ltpage, "x0") else None
+            if self.region is not None:
+                # if region coordinates are floats between 0 and 1, we scale them with the ltpage coordinates:
+                region_box = self.scale_region_box(ltpage)
+                if box is None:
+                    box = region_box
                 else:
-                    c = int(c * ltpage_h) + ltpage.y0
-            res.append(c)
-        # print("scale %s to %s" % (self.region, res))
-        return res
+                    box = (max(box[0], region_box[0]), max(box[1], region_box[1]), min(box[2], region_box[2]), min(box[3], region_box[3]))
+            self.box = box
+        return self.box
 
     def in_region(self, item, ltpage):
         if not hasattr(item, "x0"):
             return True
-        if hasattr(ltpage, "x0"):
-            if item.x0 < ltpage.x0 or item.x1 > ltpage.x1 or item.y0 < ltpage.y0 or item.y1 > ltpage.y1:
-                return False
-        if self.region is None:
+        return self.bbox_in_region(item.bbox, ltpage)
+
+    def bbox_in_region(self, bbox, ltpage):
+        box = self.page_box(ltpage)
+        if box is None:
             return True
-        # if region coordinates are floats between 0 and 1, we scale them with the ltpage coordinates:
-        region_box = self.scale_region_box(ltpage)
-        if item.x0 < region_box[0] or item.y0 < region_box[1]:
-            return False
-        if item.x1 > region_box[2] or item.y1 > region_box[3]:
-            return False
         # remove if you also want to convert invisible characters
-        
-        return True
+        return bbox[0] >= box[0] and bbox[1] >= box[1] and bbox[2] <= box[2] and bbox[3] <= box[3]
+
+    def resolve_fontname(self, fontname):
+        # removes the subset prefix (ex: "ANIELG+Dedris-a") and normalizes the
+        # name like convert_string does, cached since all the characters of a
+        # document share a handful of font names
+        res = self.fontnames.get(fontname)
+        if res is None:
+            _, sep, tail = fontname.partition('+')
+            res = normalize_font_name(tail if sep else fontname)
+            self.fontnames[fontname] = res
+        return res
+
+    def is_rotated_matrix(self, matrix):
+        # b and c are both 0 (or -0.0) for horizontal text
+        return bool(matrix) and bool(matrix[1] or matrix[2])
 
-    def is_rotated(self, item):
-        if not item.matrix:
-            return False
-        return item.matrix[1] != 0.0 or item.matrix[2] != 0.0
+    def begin_page(self, page, ctm) -> None:
+        super().begin_page(page, ctm)
+        # cur_item changes when entering figures, keep the page for render_char
+        self.render_ltpage = self.cur_item
+
+    def char_bbox(self, matrix, font, fontsize, rise, cid, adv):
+        # same bbox as the LTChar pdfminer would build
+        if font.is_vertical():
+            (vx, vy) = font.char_disp(cid)
+            vx = fontsize * 0.5 if vx is None else vx * fontsize * 0.001
+            vy = (1000 - vy) * fontsize * 0.001
+            bbox = (-vx, vy + rise + adv, -vx + fontsize, vy + rise)
+        else:
+            descent = font.get_descent() * fontsize
+            bbox = (0, descent + rise, adv, descent + rise + fontsize)
+        (x0, y0, x1, y1) = apply_matrix_rect(matrix, bbox)
+        if x1 < x0:
+            (x0, x1) = (x1, x0)
+        if y1 < y0:
+            (y0, y1) = (y1, y0)
+        return (x0, y0, x1, y1)
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate) -> float:
+        if self.remove_non_hz and self.is_rotated_matrix(matrix):
+            # dropped before an LTChar is built, which also keeps it out of the
+            # layout analysis. Only the characters in the region are counted.
+            # same advance as LTChar.adv:
+            adv = font.char_width(cid) * fontsize * scaling
+            if self.bbox_in_region(self.char_bbox(matrix, font, fontsize, rise, cid, adv), self.render_ltpage):
+                self.stats["nb_non_horizontal_removed"] += 1
+            return adv
+        # same as PDFLayoutAnalyzer.render_char, except that the characters out
+        # of the region are not added to the layout
+        try:
+            text = font.to_unichr(cid)
+            assert isinstance(text, str), str(type(text))
+        except PDFUnicodeNotDefined:
+            text = self.handle_undefined_char(font, cid)
+        textwidth = font.char_width(cid)
+        textdisp = font.char_disp(cid)
+        item = LTChar(matrix, font, fontsize, scaling, rise, text, textwidth, textdisp, ncs, graphicstate)
+        if self.bbox_in_region(item.bbox, self.render_ltpage):
+            self.cur_item.add(item)
+        return item.adv
 
     def convert_item(self, item, ltpage) -> None:
         text = item.get_text()
-        if not hasattr(item, "fontname"):
-            self.write_text(text)
-            return
-        if not self.in_region(item, ltpage):
-            #if hasattr(item, "x0"):
-            #   logging.error("x0: %f, x1: %f, y0: %f, y1: %f, in_region=False" % (item.x0, item.x1, item.y0, item.y1))
-            return
-        if self.remove_non_hz and self.is_rotated(item):
-            #logging.debug("matrix: %s is_rotated=True", item.matrix)
-            self.stats["nb_non_horizontal_removed"] += 1
-            return
+        # LTChar items are already filtered by region and orientation in
+        # render_char, the other items are checked here
+        if not isinstance(item, LTChar):
+            if not hasattr(item, "fontname"):
+                self.write_text(text)
+                return
+            if not self.in_region(item, ltpage):
+                #if hasattr(item, "x0"):
+                #   logging.error("x0: %f, x1: %f, y0: %f, y1: %f, in_region=False" % (item.x0, item.x1, item.y0, item.y1))
+                return
         #logging.error("x0: %f, x1: %f, y0: %f, y1: %f, in_region=True %s" % (item.x0, item.x1, item.y0, item.y1, item))
         #logging.error(ltpage)
-        fontname = item.fontname
         #logging.error(item.graphicstate)
-        fontname = fontname[fontname.find('+')+1:]
-        ctext = convert_string(text, fontname, self.stats)
-        if ctext is not None:
+        stats = self.stats
+        fontname = self.resolve_fontname(item.fontname)
+        if fontname in self.unhandled_fontnames and not text.startswith("(cid:"):
+            # same result and stats as convert_string for a font without table
+            stats["unhandled_fonts"][fontname] += 1
+            self.write_text(text)
+            return
+        ctext = convert_string(text, fontname, stats)
+        if ctext is None:
+            self.unhandled_fontnames.add(fontname)
+        else:
             text = ctext
         self.write_text(text)
 
     def write_text(self, text: str) -> None:
-        text = compatible_encode_method(text, self.codec, "ignore")
+        self.page_text.append(text)
+
+    def flush_text(self) -> None:
+        text = "".join(self.page_text)
+        self.page_text = []
         if self.outfp_binary:
             cast(BinaryIO, self.outfp).write(text.encode())
         else:
             cast(TextIO, self.outfp).write(text)
 
     def receive_layout(self, ltpage: LTPage) -> None:
-        def render(item: LTItem, linenumref) -> None:
-            if isinstance(item, LTContainer):
-                for child in item:
-                    render(child, linenumref)
-            elif isinstance(item, LTText):
-                if linenumref["linenum"] <= self.maxlines:
-                    self.convert_item(item, ltpage)
-            if isinstance(item, LTTextBox):
-                self.write_text("\n")
-                linenumref["linenum"] += 1
-            elif isinstance(item, LTImage):
+        # depth-first traversal with an explicit stack rather than recursion,
+        # END_OF_TEXTBOX is popped once all the children of a text box are
+        # rendered
+        linenum = 1
+        stack = [ltpage]
+        # attribute lookups hoisted out of the loop, it runs for every item
+        pop = stack.pop
+        push = stack.append
+        extend = stack.extend
+        get_kind = LAYOUT_KINDS.get
+        write_text = self.write_text
+        convert_item = self.convert_item
+        maxlines = self.maxlines
+        write_text(self.pbs.format(ltpage.pageid))
+        while stack:
+            item = pop()
+            if item is END_OF_TEXTBOX:
+                write_text("\n")
+                linenum += 1
+                continue
+            kind = get_kind(type(item))
+            if kind is None:
+                kind = layout_kind(type(item))
+            if kind == TEXT:
+                if linenum <= maxlines:
+                    convert_item(item, ltpage)
+            elif kind == CONTAINER:
+                extend(reversed(list(item)))
+            elif kind == TEXTBOX:
+                push(END_OF_TEXTBOX)
+                extend(reversed(list(item)))
+            elif kind == IMAGE:
                 if self.imagewriter is not None:
                     self.imagewriter.export_image(item)
-        self.write_text(self.pbs.format(ltpage.pageid))
-        render(ltpage, {"linenum": 1})
+        self.flush_text()
 
     # Some dummy functions to save memory/CPU when all that is wanted
     # is text.  This stops all the image and drawing output from being